@@ -1,6 +1,8 @@
 import sys
 import os
-import json
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QPushButton, QLabel, QFileDialog,
@@ -9,6 +11,12 @@ from PyQt6.QtWidgets import (
 from PyQt6.QtCore import Qt
 from PIL import Image
 import numpy as np
+from ccvi_format import plane_table, load_ccvi, save_ccvi_binary, save_ccvi_json
+
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
 
 def get_default_save_path(input_path, output_path=None, ext=".ccvi"):
     if output_path:
@@ -19,78 +27,230 @@ def get_default_save_path(input_path, output_path=None, ext=".ccvi"):
         os.makedirs(photos, exist_ok=True)
         return photos / (Path(input_path).stem + ext)
 
-def convert_to_ccvi(img_path, save_path=None, margin_error=0.1):
+def _extract_vectors_numpy(arr, idx):
+    ys, xs = np.divmod(idx, arr.shape[1])
+    return xs.astype(np.int32), ys.astype(np.int32), arr[ys, xs, 3]
+
+# Set once warm_up_kernels has compiled the Numba kernel
+_kernel_ready = threading.Event()
+
+if njit is not None:
+    # Compiled lazily on first call; cache=True persists the machine code so
+    # later launches only load it from disk
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _extract_vectors_jit(arr, idx):
+        """Gather x, y and alpha columns for flat pixel indices."""
+        n = idx.shape[0]
+        width = arr.shape[1]
+        xs = np.empty(n, np.int32)
+        ys = np.empty(n, np.int32)
+        alphas = np.empty(n, np.uint8)
+        for k in prange(n):
+            y = idx[k] // width
+            x = idx[k] - y * width
+            xs[k] = x
+            ys[k] = y
+            alphas[k] = arr[y, x, 3]
+        return xs, ys, alphas
+else:
+    _extract_vectors_jit = None
+
+def _extract_vectors(arr, idx):
+    # Calling the kernel while it compiles would block on Numba's dispatcher
+    # lock, so use the NumPy gather until warm-up has finished
+    if _kernel_ready.is_set():
+        return _extract_vectors_jit(arr, idx)
+    return _extract_vectors_numpy(arr, idx)
+
+def warm_up_kernels():
+    """Compile (or load from cache) the Numba kernel on a 1x1 image, then switch conversions over to it."""
+    if _extract_vectors_jit is None:
+        return
+    # Decoded images arrive as read-only views, so compile for those
+    arr = np.zeros((1, 1, 4), dtype=np.uint8)
+    arr.flags.writeable = False
+    _extract_vectors_jit(arr, np.zeros(1, dtype=np.int64))
+    _kernel_ready.set()
+
+def start_kernel_warm_up():
+    """Warm the Numba kernel up on a daemon thread; call from the main thread."""
+    if _extract_vectors_jit is None:
+        return
+    # Start Numba's thread pool here: a TBB pool first launched from another
+    # thread keeps the interpreter from exiting
+    get_num_threads()
+    threading.Thread(target=warm_up_kernels, daemon=True).start()
+
+# Opt-in k-means sampling of the few largest, heavily decimated planes. Each
+# fit runs on a fixed-size sample with random init and capped iterations, so
+# the cost is bounded by the fit count rather than the image size; every
+# other plane uses the random sampler.
+KMEANS_MIN_PIXELS = 16384
+KMEANS_MAX_CLUSTERS = 2048
+KMEANS_MAX_FITS = 4
+KMEANS_SAMPLE = 8192
+KMEANS_MAX_ITER = 5
+
+@functools.lru_cache(maxsize=None)
+def _kmeans():
+    """MiniBatchKMeans, imported on first use since scikit-learn is slow to import; None if missing."""
+    try:
+        from sklearn.cluster import MiniBatchKMeans
+    except ImportError:
+        return None
+    return MiniBatchKMeans
+
+def _clustered_planes(sizes, num_vectors):
+    """Boolean mask of the planes worth sampling with k-means."""
+    cluster = (
+        (sizes >= KMEANS_MIN_PIXELS) & (num_vectors >= 2)
+        & (num_vectors < sizes / 8) & (num_vectors <= KMEANS_MAX_CLUSTERS)
+    )
+    candidates = np.flatnonzero(cluster)
+    if len(candidates) > KMEANS_MAX_FITS:
+        # Keep only the largest planes
+        cluster[:] = False
+        cluster[candidates[np.argsort(sizes[candidates])[-KMEANS_MAX_FITS:]]] = True
+    if len(candidates) and _kmeans() is None:
+        cluster[:] = False
+    return cluster
+
+def _sample_plane(members, num_vectors, width, seed, cluster=False):
+    """Pick num_vectors of a plane's flat pixel indices, in row-major order."""
+    if num_vectors >= len(members):
+        return members
+    rng = np.random.default_rng(seed)
+    if cluster:
+        # Heavy decimation: cluster a sample of the plane's pixels and keep the
+        # sampled member nearest each centre, so vectors spread evenly over the shape
+        members = rng.choice(members, min(len(members), KMEANS_SAMPLE), replace=False, shuffle=False)
+        points = np.column_stack(np.divmod(members, width)).astype(np.float32)
+        km = _kmeans()(
+            n_clusters=num_vectors, init="random", batch_size=4096, max_iter=KMEANS_MAX_ITER,
+            n_init=1, random_state=0
+        ).fit(points)
+        labels = km.labels_
+        dist = ((points - km.cluster_centers_[labels]) ** 2).sum(axis=1)
+        by_cluster = np.lexsort((dist, labels))
+        sorted_labels = labels[by_cluster]
+        nearest = by_cluster[np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]]
+        return np.sort(members[nearest])
+    # Unbiased random subset
+    return np.sort(rng.choice(members, num_vectors, replace=False, shuffle=False))
+
+def convert_to_ccvi(img_path, save_path=None, margin_error=0.1, binary=True, cluster=False):
     """
     Simplified gradient vector approximation.
     margin_error: 0.0 -> perfect fidelity, 1.0 -> extreme lossiness
+    binary: write the binary container, or the legacy JSON layout if False
+    cluster: place the vectors of large, heavily decimated planes by k-means
+             (needs scikit-learn; slower, same number of vectors)
     """
-    img = Image.open(img_path).convert("RGBA")
-    arr = np.array(img)
-    
-    colors = np.unique(arr.reshape(-1, arr.shape[2]), axis=0)
-    planes = []
-    
-    for color in colors:
-        mask = np.all(arr[:, :, :3] == color[:3], axis=2)
-        if not np.any(mask):
-            continue
-        mask_indices = np.argwhere(mask)
-        num_vectors = max(1, int(len(mask_indices) * (1 - margin_error)))
-        sampled_indices = mask_indices[::max(1, len(mask_indices)//num_vectors)]
-        
-        vectors = []
-        for y, x in sampled_indices:
-            height = arr[y, x, :3].mean() / 255.0  
-            saturation = (np.max(arr[y, x, :3]) - np.min(arr[y, x, :3])) / 255.0
-            alpha = arr[y, x, 3] / 255.0
-            vectors.append({
-                "x": int(x),
-                "y": int(y),
-                "height": float(height),
-                "saturation": float(saturation),
-                "alpha": float(alpha)
-            })
-        
-        planes.append({
-            "color": color[:3].tolist(),
-            "vectors": vectors
-        })
+    with Image.open(img_path) as img:
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        # Read-only view of the decoded pixels, no extra copy
+        arr = np.asarray(img)
+    height, width = arr.shape[:2]
+    
+    # Group pixels by RGB, reading each RGBA pixel as one little-endian uint32
+    packed = np.ascontiguousarray(arr).reshape(-1, 4).view("<u4").ravel() & 0x00FFFFFF
+    colors, inverse = np.unique(packed, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(colors) + 1))
+    
+    sizes = np.diff(bounds)
+    num_vectors = np.maximum(1, (sizes * (1 - margin_error)).astype(np.int64))
+    if cluster:
+        clustered = _clustered_planes(sizes, num_vectors)
+    else:
+        clustered = np.zeros(len(sizes), dtype=bool)
+    
+    def sample_planes(plane_indices):
+        sampled = []
+        for i in plane_indices.tolist():
+            members = order[bounds[i]:bounds[i + 1]]
+            sampled.append(_sample_plane(members, int(num_vectors[i]), width, seed=i, cluster=clustered[i]))
+        return sampled
+    
+    # Planes are independent; sample them in a few chunks per core
+    n_chunks = min(len(colors), 4 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor() as executor:
+        chunks = executor.map(sample_planes, np.array_split(np.arange(len(colors)), n_chunks))
+        sampled = [indices for chunk in chunks for indices in chunk]
+    
+    # One kernel call over every sampled pixel; the planes stay contiguous
+    # runs of the flat columns
+    counts = np.array([len(indices) for indices in sampled], dtype=np.int64)
+    xs, ys, alpha = _extract_vectors(arr, np.concatenate(sampled).astype(np.int64))
+    # Every plane keeps at least one vector, so no reduceat segment is empty
+    has_alpha = np.minimum.reduceat(alpha, np.r_[0, np.cumsum(counts)[:-1]]) < 255
+    rgb_colors = colors.astype("<u4").view(np.uint8).reshape(-1, 4)[:, :3]
     
     ccvi_data = {
-        "width": img.width,
-        "height": img.height,
-        "planes": planes,
+        "width": width,
+        "height": height,
+        "planes": plane_table(rgb_colors, counts, has_alpha),
+        "x": xs,
+        "y": ys,
+        "alpha": alpha if has_alpha.any() else None,
         "margin_error": margin_error
     }
     
     save_path = get_default_save_path(img_path, save_path, ext=".ccvi")
-    with open(save_path, "w") as f:
-        json.dump(ccvi_data, f)
+    if binary:
+        save_ccvi_binary(save_path, ccvi_data)
+    else:
+        save_ccvi_json(save_path, ccvi_data)
     return save_path
 
 def convert_from_ccvi(ccvi_path, save_path=None):
-    with open(ccvi_path, "r") as f:
-        data = json.load(f)
+    data = load_ccvi(ccvi_path)
     
     width, height = data["width"], data["height"]
-    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    planes = data["planes"]
+    n_pixels = width * height
+    
+    keys = data["y"].astype(np.int64) * width + data["x"]
+    rgb = np.repeat(planes["color"], planes["count"], axis=0)
+    alpha = data["alpha"]
+    
+    hits = np.bincount(keys, minlength=n_pixels)
+    covered = bool(hits.all())
+    if len(keys) > np.count_nonzero(hits):
+        # Overlapping vectors: keep the last one written to each pixel, as
+        # drawing the planes in order would
+        keys, last = np.unique(keys[::-1], return_index=True)
+        last = len(rgb) - 1 - last
+        rgb = rgb[last]
+        if alpha is not None:
+            alpha = alpha[last]
+    
+    has_alpha = not covered or (alpha is not None and bool(np.any(alpha < 255)))
     
-    for plane in data["planes"]:
-        color = plane["color"]
-        for vec in plane["vectors"]:
-            x, y = vec["x"], vec["y"]
-            canvas[y, x, :3] = color
-            canvas[y, x, 3] = int(vec["alpha"] * 255)
+    # One scatter of every vector; uncovered pixels are zero-filled, which
+    # leaves them fully transparent
+    channels = 4 if has_alpha else 3
+    pixels = (np.empty if covered else np.zeros)((n_pixels, channels), dtype=np.uint8)
+    pixels[keys, :3] = rgb
+    if has_alpha:
+        pixels[keys, 3] = 255 if alpha is None else alpha
     
-    if np.any(canvas[:, :, 3] < 255):
+    if has_alpha:
         ext = "png"
-        img = Image.fromarray(canvas, "RGBA")
+        # Shares the canvas buffer instead of copying it
+        img = Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
     else:
         ext = "jpeg"
-        img = Image.fromarray(canvas, "RGBA").convert("RGB")
+        img = Image.fromarray(pixels.reshape(height, width, 3))
     
     save_path = get_default_save_path(ccvi_path, save_path, ext=f".{ext}")
-    img.save(save_path)
+    save_options = {}
+    if not has_alpha and save_path.suffix.lower() in (".jpg", ".jpeg"):
+        # Pillow's default quality, lowered further for lossier CCVIs
+        margin_error = data.get("margin_error", 0.0)
+        save_options = {"quality": round(75 - 25 * margin_error), "optimize": True}
+    img.save(save_path, **save_options)
     return save_path
 
 class CCVIConverterUI(QWidget):
@@ -170,4 +330,7 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = CCVIConverterUI()
     window.show()
+    # Compile (or load from cache) the kernel off the UI thread once the window
+    # is up; conversions use the slower NumPy gather until it is ready
+    start_kernel_warm_up()
     sys.exit(app.exec())
@@ -1,5 +1,4 @@
 import sys
-import json
 import math
 from pathlib import Path
 from PyQt6.QtWidgets import (
@@ -7,7 +6,28 @@ from PyQt6.QtWidgets import (
     QLabel, QPushButton, QFileDialog, QSpinBox, QCheckBox
 )
 from PyQt6.QtCore import Qt, QTimer, QRect
-from PyQt6.QtGui import QPixmap, QImage, QPainter, QColor, QPen, QWheelEvent
+from PyQt6.QtGui import QPixmap, QImage, QWheelEvent
+import numpy as np
+from ccvi_format import load_ccvi
+
+BACKGROUND = 240
+MAX_VECTOR_SIZE = 10
+
+def _blend_lut():
+    """lut[alpha, channel] is the channel value composited over the background at that alpha"""
+    alpha = np.arange(256, dtype=np.uint32)[:, None]
+    channel = np.arange(256, dtype=np.uint32)[None, :]
+    return ((channel * alpha + BACKGROUND * (255 - alpha) + 127) // 255).astype(np.uint8)
+
+BLEND_LUT = _blend_lut()
+
+def _disk_offsets(size):
+    """(dy, dx) offsets of the pixels covered by a vector point of the given size"""
+    r = np.arange(size) - size // 2
+    dy, dx = np.meshgrid(r, r, indexing="ij")
+    center = (size - 1) / 2 - size // 2
+    inside = (dy - center) ** 2 + (dx - center) ** 2 <= (size / 2) ** 2
+    return dy[inside].tolist(), dx[inside].tolist()
 
 class CCVIViewer(QMainWindow):
     def __init__(self):
@@ -24,6 +44,11 @@ class CCVIViewer(QMainWindow):
         self.original_pixmap = None  # Base rendered image at 100%
         self.display_pixmap = None   # Currently displayed (zoomed) version
         self.needs_rerender = True   # Flag to track when we need to redraw
+        self._bg_np = None           # Padded background with every vector as one pixel
+        self._frame_np = None        # Reused buffer for stamping larger vectors
+        self._points = None          # (ys, xs, composited rgb) of every vector
+        self._sprites = {}           # Disk offsets per vector size
+        self._stamped_size = None    # Vector size of original_pixmap
         
         # Animation
         self.animation_timer = QTimer()
@@ -67,7 +92,7 @@ class CCVIViewer(QMainWindow):
         vector_size_layout = QHBoxLayout()
         vector_size_layout.addWidget(QLabel("Vector Size:"))
         self.vector_size_spin = QSpinBox()
-        self.vector_size_spin.setRange(1, 10)
+        self.vector_size_spin.setRange(1, MAX_VECTOR_SIZE)
         self.vector_size_spin.setValue(2)
         vector_size_layout.addWidget(self.vector_size_spin)
         
@@ -117,8 +142,7 @@ class CCVIViewer(QMainWindow):
     
     def load_ccvi_file(self, file_path):
         try:
-            with open(file_path, 'r') as f:
-                self.ccvi_data = json.load(f)
+            self.ccvi_data = load_ccvi(file_path)
             
             self.file_label.setText(f"Loaded: {Path(file_path).name}")
             self.reset_view()
@@ -133,7 +157,7 @@ class CCVIViewer(QMainWindow):
         if not self.ccvi_data:
             return
         
-        total_vectors = sum(len(plane['vectors']) for plane in self.ccvi_data['planes'])
+        total_vectors = len(self.ccvi_data['x'])
         info_text = f"""Dimensions: {self.ccvi_data['width']} x {self.ccvi_data['height']}
 Planes: {len(self.ccvi_data['planes'])}
 Vectors: {total_vectors}
@@ -145,59 +169,81 @@ Margin: {self.ccvi_data.get('margin_error', 'N/A')}"""
         if not self.ccvi_data:
             return
         
-        # Only redraw the base image if something fundamental changed
-        if self.needs_rerender or self.original_pixmap is None:
-            self.render_base_image()
+        # Only rebuild the background if the file itself changed
+        if self.needs_rerender or self._bg_np is None:
+            self.render_background_pixmap()
             self.needs_rerender = False
         
+        self.render_base_image()
+        
         # Apply zoom to create display pixmap (this is cheap)
         self.apply_zoom()
     
-    def render_base_image(self):
-        """Render the base image at 100% scale - this is the expensive operation"""
+    def render_background_pixmap(self):
+        """Composite every vector as a single pixel over the background - this is the expensive operation"""
         width = self.ccvi_data['width']
         height = self.ccvi_data['height']
+        planes = self.ccvi_data['planes']
         
-        # Create image
-        image = QImage(width, height, QImage.Format.Format_ARGB32)
-        image.fill(Qt.GlobalColor.transparent)
+        xs = self.ccvi_data['x'].astype(np.intp)
+        ys = self.ccvi_data['y'].astype(np.intp)
+        rgb = np.repeat(planes['color'], planes['count'], axis=0)
         
-        painter = QPainter(image)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        # Composite translucent vectors over the background once, like QPainter would;
+        # opaque planes keep their colour as-is
+        alpha = self.ccvi_data['alpha']
+        if alpha is not None:
+            translucent = alpha < 255
+            rgb[translucent] = BLEND_LUT[alpha[translucent][:, None], rgb[translucent]]
         
-        # Draw background
-        painter.fillRect(0, 0, width, height, QColor(240, 240, 240))
+        # Pad the canvas so stamped disks never need bounds checks
+        pad = MAX_VECTOR_SIZE
+        self._points = (ys + pad, xs + pad, rgb)
+        self._bg_np = np.full((height + 2 * pad, width + 2 * pad, 3), BACKGROUND, dtype=np.uint8)
+        self._bg_np[ys + pad, xs + pad] = rgb
+        self._frame_np = None
+        self._stamped_size = None
+    
+    def stamp_vectors(self, size):
+        """Stamp every vector as a disk of the given size over the cached background"""
+        if size == 1:
+            frame = self._bg_np
+        else:
+            if self._frame_np is None:
+                self._frame_np = np.empty_like(self._bg_np)
+            np.copyto(self._frame_np, self._bg_np)
+            if size not in self._sprites:
+                self._sprites[size] = _disk_offsets(size)
+            ys, xs, rgb = self._points
+            for dy, dx in zip(*self._sprites[size]):
+                self._frame_np[ys + dy, xs + dx] = rgb
+            frame = self._frame_np
         
-        # Draw color planes
-        for plane in self.ccvi_data['planes']:
-            color = QColor(*plane['color'])
-            
-            for vec in plane['vectors']:
-                x, y = vec['x'], vec['y']
-                alpha = int(vec.get('alpha', 1.0) * 255)
-                color.setAlpha(alpha)
-                
-                if self.show_vectors:
-                    # Draw vector points
-                    size = self.vector_size
-                    if self.is_animating:
-                        # Subtle pulsing for animation
-                        pulse = math.sin(self.animation_phase) * 0.3 + 0.7
-                        animated_size = max(1, int(size * pulse))
-                    else:
-                        animated_size = size
-                    
-                    painter.setPen(QPen(color, 1))
-                    painter.setBrush(color)
-                    painter.drawEllipse(x - animated_size//2, y - animated_size//2, 
-                                      animated_size, animated_size)
-                else:
-                    # Simple pixel
-                    painter.setPen(color)
-                    painter.drawPoint(x, y)
+        width = self.ccvi_data['width']
+        height = self.ccvi_data['height']
+        pad = MAX_VECTOR_SIZE
+        canvas = frame[pad:pad + height, pad:pad + width].tobytes()
+        image = QImage(canvas, width, height, 3 * width, QImage.Format.Format_RGB888)
+        return QPixmap.fromImage(image)
+    
+    def render_base_image(self):
+        """Render the base image at 100% scale, restamping only when the vector size changed"""
+        if self.show_vectors:
+            # Draw vector points
+            size = self.vector_size
+            if self.is_animating:
+                # Subtle pulsing for animation
+                pulse = math.sin(self.animation_phase) * 0.3 + 0.7
+                size = max(1, int(size * pulse))
+        else:
+            # Simple pixel
+            size = 1
         
-        painter.end()
-        self.original_pixmap = QPixmap.fromImage(image)
+        if size == self._stamped_size and self.original_pixmap is not None:
+            return False
+        self.original_pixmap = self.stamp_vectors(size)
+        self._stamped_size = size
+        return True
     
     def apply_zoom(self):
         """Apply zoom transformation - this is cheap"""
@@ -208,13 +254,19 @@ Margin: {self.ccvi_data.get('margin_error', 'N/A')}"""
             # No zoom, use original
             self.display_pixmap = self.original_pixmap
         else:
-            # Scale the original pixmap
-            scaled_width = int(self.original_pixmap.width() * self.zoom_factor)
-            scaled_height = int(self.original_pixmap.height() * self.zoom_factor)
+            # Scale the original pixmap, nearest-neighbour when magnifying or at
+            # integer factors since the base image is pixel art anyway
+            zf = self.zoom_factor
+            if zf >= 1.0 or abs(zf - round(zf)) < 0.01:
+                mode = Qt.TransformationMode.FastTransformation
+            else:
+                mode = Qt.TransformationMode.SmoothTransformation
+            scaled_width = int(self.original_pixmap.width() * zf)
+            scaled_height = int(self.original_pixmap.height() * zf)
             self.display_pixmap = self.original_pixmap.scaled(
                 scaled_width, scaled_height,
                 Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
+                mode
             )
         
         self.image_display.setPixmap(self.display_pixmap)
@@ -234,12 +286,10 @@ Margin: {self.ccvi_data.get('margin_error', 'N/A')}"""
     
     def on_vector_toggle(self, checked):
         self.show_vectors = checked
-        self.needs_rerender = True  # Need to redraw base image
         self.render_image()
     
     def on_vector_size_change(self, size):
         self.vector_size = size
-        self.needs_rerender = True  # Need to redraw base image
         self.render_image()
     
     def on_animation_toggle(self, checked):
@@ -248,10 +298,8 @@ Margin: {self.ccvi_data.get('margin_error', 'N/A')}"""
             self.animation_timer.start(100)  # 10 FPS - much gentler
         else:
             self.animation_timer.stop()
-            # Only rerender if we were animating and now we're not
-            if not checked:
-                self.needs_rerender = True
-                self.render_image()
+            # Back to the resting vector size
+            self.render_image()
     
     def on_animation_frame(self):
         """Animation frame - only update phase and rerender if needed"""
@@ -259,9 +307,10 @@ Margin: {self.ccvi_data.get('margin_error', 'N/A')}"""
         if self.animation_phase > 2 * math.pi:
             self.animation_phase = 0
         
-        if self.is_animating:
-            self.needs_rerender = True
-            self.render_image()
+        if self.is_animating and self.ccvi_data:
+            # Only the vector size pulses, so restamp just when it changes
+            if self.render_base_image():
+                self.apply_zoom()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
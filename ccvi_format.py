@@ -0,0 +1,224 @@
+"""Reading and writing .ccvi files, shared by the converter and the viewer."""
+import json
+import struct
+from pathlib import Path
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=lambda arr: arr.tolist()).encode()
+
+def _json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+# A .ccvi image is a plane table, one row per colour, plus flat x, y and alpha
+# columns holding every plane's vectors back to back in table order. Height and
+# saturation derive from the colour; alpha is None when every vector is opaque,
+# and on disk it is stored only for the planes flagged has_alpha.
+# Version 1 JSON stored 0..1 floats, versions 1-2 repeated height/saturation per
+# vector, and versions 1-3 stored each plane's columns next to its header.
+CCVI_VERSION = 4
+
+PLANE_DTYPE = np.dtype([
+    ("color", "u1", 3), ("height", "u1"), ("saturation", "u1"), ("has_alpha", "?"), ("count", "<u4")
+])
+
+def plane_attributes(colors):
+    """Height and saturation (0..255) of each row of an (n, 3) colour array."""
+    colors = np.asarray(colors, dtype=np.int32)
+    return colors.sum(axis=-1) // 3, colors.max(axis=-1) - colors.min(axis=-1)
+
+def plane_table(colors, counts, has_alpha):
+    """Plane table for an (n, 3) colour array, the vector count and alpha flag of each plane."""
+    planes = np.empty(len(counts), dtype=PLANE_DTYPE)
+    planes["color"] = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    planes["height"], planes["saturation"] = plane_attributes(planes["color"])
+    planes["has_alpha"] = has_alpha
+    planes["count"] = counts
+    return planes
+
+def _stored_alpha(ccvi_data):
+    """Alpha of the planes flagged has_alpha, the only alpha written to disk."""
+    planes = ccvi_data["planes"]
+    if not planes["has_alpha"].any():
+        return np.empty(0, dtype=np.uint8)
+    return ccvi_data["alpha"][np.repeat(planes["has_alpha"], planes["count"])]
+
+def _expand_alpha(stored, planes):
+    """Whole-image alpha column from the stored alpha of the has_alpha planes; None if there is none."""
+    if not planes["has_alpha"].any():
+        return None
+    if planes["has_alpha"].all():
+        return stored
+    alpha = np.full(int(planes["count"].sum()), 255, dtype=np.uint8)
+    alpha[np.repeat(planes["has_alpha"], planes["count"])] = stored
+    return alpha
+
+def _columns_from_json(data, version):
+    """Plane table and flat columns from any JSON layout."""
+    planes = data["planes"]
+    if version >= 4:
+        table = plane_table(planes["color"], planes["count"], planes["has_alpha"])
+        data["planes"] = table
+        data["x"] = np.asarray(data["x"], dtype=np.int32)
+        data["y"] = np.asarray(data["y"], dtype=np.int32)
+        data["alpha"] = _expand_alpha(np.asarray(data["alpha"], dtype=np.uint8), table)
+        return data
+    if planes and "vectors" in planes[0]:
+        # Legacy layout: one dict per vector, each with its own alpha
+        vectors = [vec for plane in planes for vec in plane["vectors"]]
+        counts = [len(plane["vectors"]) for plane in planes]
+        has_alpha = True
+        x = [vec["x"] for vec in vectors]
+        y = [vec["y"] for vec in vectors]
+        alpha = [vec.get("alpha", 1.0) for vec in vectors]
+    else:
+        counts = [len(plane["x"]) for plane in planes]
+        has_alpha = ["alpha" in plane for plane in planes]
+        x = [value for plane in planes for value in plane["x"]]
+        y = [value for plane in planes for value in plane["y"]]
+        alpha = [value for plane in planes if "alpha" in plane for value in plane["alpha"]]
+    if version >= 2:
+        alpha = np.asarray(alpha, dtype=np.uint8)
+    else:
+        alpha = np.rint(np.asarray(alpha, dtype=np.float64) * 255).astype(np.uint8)
+    
+    colors = [value for plane in planes for value in plane["color"]]
+    table = plane_table(colors, counts, has_alpha)
+    data["planes"] = table
+    data["x"] = np.asarray(x, dtype=np.int32)
+    data["y"] = np.asarray(y, dtype=np.int32)
+    data["alpha"] = _expand_alpha(alpha, table)
+    return data
+
+# Binary container: header, the plane table (padded to a 4 byte boundary), then
+# the x, y and stored alpha columns of all planes
+CCVI_MAGIC = b"CCVI"
+_HEADER = struct.Struct("<4sIIIIf")  # magic, version, width, height, n_planes, margin_error
+_PLANE_HEADER = struct.Struct("<3BBBBI")  # r, g, b, height, saturation, has_alpha, n_vectors
+_PLANE_HEADER_V2 = struct.Struct("<3BI")  # r, g, b, n_vectors
+_COORD = np.dtype("<i4")
+_BYTE = np.dtype(np.uint8)
+
+def _padding(offset):
+    return -offset % _COORD.itemsize
+
+def save_ccvi_binary(save_path, ccvi_data):
+    planes = np.ascontiguousarray(ccvi_data["planes"], dtype=PLANE_DTYPE)
+    with open(save_path, "wb") as f:
+        f.write(_HEADER.pack(
+            CCVI_MAGIC, CCVI_VERSION, ccvi_data["width"], ccvi_data["height"],
+            len(planes), ccvi_data["margin_error"]
+        ))
+        f.write(memoryview(planes).cast("B"))
+        f.write(bytes(_padding(_HEADER.size + planes.nbytes)))
+        f.write(memoryview(np.ascontiguousarray(ccvi_data["x"], dtype=_COORD)))
+        f.write(memoryview(np.ascontiguousarray(ccvi_data["y"], dtype=_COORD)))
+        f.write(memoryview(np.ascontiguousarray(_stored_alpha(ccvi_data), dtype=_BYTE)))
+
+def _load_binary_columns(raw, n_planes):
+    """Plane table and columns of the current layout, as views of the file buffer."""
+    offset = _HEADER.size
+    planes = np.frombuffer(raw, dtype=PLANE_DTYPE, count=n_planes, offset=offset)
+    offset += planes.nbytes + _padding(offset + planes.nbytes)
+    total = int(planes["count"].sum())
+    x = np.frombuffer(raw, dtype=_COORD, count=total, offset=offset)
+    offset += x.nbytes
+    y = np.frombuffer(raw, dtype=_COORD, count=total, offset=offset)
+    offset += y.nbytes
+    n_alpha = int(planes["count"][planes["has_alpha"]].sum())
+    stored_alpha = np.frombuffer(raw, dtype=_BYTE, count=n_alpha, offset=offset)
+    return planes, x, y, stored_alpha
+
+def _gather(raw, starts, sizes):
+    """Concatenate the byte ranges raw[start:start + size] with one fancy index instead of a copy per range."""
+    ends = np.cumsum(sizes, dtype=np.int64)
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - sizes), sizes)
+    return np.frombuffer(raw, dtype=_BYTE)[positions]
+
+def _load_interleaved_columns(raw, version, n_planes):
+    """Plane table and columns of the version 1-3 layout, with a header before each plane's columns."""
+    # Walk the plane headers to find where each plane's columns start
+    rows = []
+    offset = _HEADER.size
+    for _ in range(n_planes):
+        if version >= 3:
+            r, g, b, _, _, has_alpha, n = _PLANE_HEADER.unpack_from(raw, offset)
+            offset += _PLANE_HEADER.size
+        else:
+            r, g, b, n = _PLANE_HEADER_V2.unpack_from(raw, offset)
+            offset += _PLANE_HEADER_V2.size
+            has_alpha = True
+        coords = offset
+        offset += 2 * n * _COORD.itemsize
+        if version < 3:
+            # Skip the per-vector height and saturation columns
+            offset += 2 * n
+        rows.append((r, g, b, has_alpha, n, coords, offset))
+        if has_alpha:
+            offset += n
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 7)
+    counts, coords = rows[:, 4], rows[:, 5]
+    planes = plane_table(rows[:, :3], counts, rows[:, 3].astype(bool))
+    
+    coord_bytes = counts * _COORD.itemsize
+    x = _gather(raw, coords, coord_bytes).view(_COORD)
+    y = _gather(raw, coords + coord_bytes, coord_bytes).view(_COORD)
+    stored_alpha = _gather(raw, rows[:, 6][planes["has_alpha"]], counts[planes["has_alpha"]])
+    return planes, x, y, stored_alpha
+
+def _load_ccvi_binary(raw):
+    _, version, width, height, n_planes, margin_error = _HEADER.unpack_from(raw)
+    if not 1 <= version <= CCVI_VERSION:
+        raise ValueError(f"Unsupported CCVI version: {version}")
+    if version >= 4:
+        planes, x, y, stored_alpha = _load_binary_columns(raw, n_planes)
+    else:
+        planes, x, y, stored_alpha = _load_interleaved_columns(raw, version, n_planes)
+    return {
+        "version": version,
+        "width": width,
+        "height": height,
+        "planes": planes,
+        "x": x,
+        "y": y,
+        "alpha": _expand_alpha(stored_alpha, planes),
+        # Stored as f32; round off the float noise so 0.1 reads back as 0.1
+        "margin_error": round(margin_error, 6)
+    }
+
+def load_ccvi(ccvi_path):
+    """Load a binary or legacy JSON .ccvi file as a plane table and flat NumPy columns."""
+    raw = Path(ccvi_path).read_bytes()
+    if raw[:len(CCVI_MAGIC)] == CCVI_MAGIC:
+        return _load_ccvi_binary(raw)
+    data = _json_loads(raw)
+    version = data.get("version", 1)
+    if version > CCVI_VERSION:
+        raise ValueError(f"Unsupported CCVI version: {version}")
+    return _columns_from_json(data, version)
+
+def save_ccvi_json(save_path, ccvi_data):
+    """Stream the JSON layout one column at a time instead of building the whole document."""
+    header = {key: value for key, value in ccvi_data.items() if key not in ("planes", "x", "y", "alpha")}
+    header["version"] = CCVI_VERSION
+    planes = ccvi_data["planes"]
+    with open(save_path, "wb") as f:
+        f.write(_json_dumps(header)[:-1])
+        f.write(b',"planes":')
+        f.write(_json_dumps({field: np.ascontiguousarray(planes[field]) for field in PLANE_DTYPE.names}))
+        f.write(b',"x":')
+        f.write(_json_dumps(np.ascontiguousarray(ccvi_data["x"])))
+        f.write(b',"y":')
+        f.write(_json_dumps(np.ascontiguousarray(ccvi_data["y"])))
+        f.write(b',"alpha":')
+        f.write(_json_dumps(_stored_alpha(ccvi_data)))
+        f.write(b"}")